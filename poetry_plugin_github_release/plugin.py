@@ -2,22 +2,147 @@
 Poetry plugin and subcommand for creating GitHub releases.
 """
 
+import configparser
 import json
 import os
 import re
-import subprocess
+import stat
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from urllib.parse import urlencode
+from urllib.request import getproxies, proxy_bypass
 
-import requests
+import certifi
+import urllib3
+from cleo.formatters.formatter import Formatter
 from cleo.helpers import option
 from poetry.console.application import Application
 from poetry.console.commands.command import Command
-from poetry.core.factory import Factory
 from poetry.core.masonry.utils.helpers import escape_name
-from poetry.core.poetry import Poetry
 from poetry.plugins.application_plugin import ApplicationPlugin
+from urllib3.util.retry import Retry
+
+# Maximum number of connections kept alive per host, which also limits the concurrent uploads.
+_HTTP_POOL_MAXSIZE = 8
+
+# Certificate bundle used to verify GitHub, the same one `requests` would use.
+_CA_CERTS = (
+    os.environ.get("REQUESTS_CA_BUNDLE") or os.environ.get("CURL_CA_BUNDLE") or certifi.where()
+)
+
+# Connection pool options shared by the direct and the proxied connections. All calls are POST
+# requests, which aren't idempotent, so only failures to connect are retried.
+_HTTP_POOL_OPTIONS: Dict[str, Any] = {
+    "num_pools": 2,
+    "maxsize": _HTTP_POOL_MAXSIZE,
+    "retries": Retry(total=5, backoff_factor=0.5),
+    "ca_certs": _CA_CERTS,
+}
+
+# Shared connection pool for all GitHub API calls, so that connections are kept alive and reused
+# between the release creation and the asset uploads.
+_http = urllib3.PoolManager(**_HTTP_POOL_OPTIONS)
+
+# Connection pool for GitHub API calls through the proxy set in the environment (`HTTPS_PROXY`),
+# if there is one. Like `requests`, a proxy without a scheme is assumed to be an HTTP proxy.
+_https_proxy: Optional[str] = getproxies().get("https")
+_http_proxy: Optional[urllib3.ProxyManager] = (
+    urllib3.ProxyManager(
+        _https_proxy if "://" in _https_proxy else f"http://{_https_proxy}", **_HTTP_POOL_OPTIONS
+    )
+    if _https_proxy
+    else None
+)
+
+# Headers sent with every GitHub API call, in addition to the authorization header.
+_HEADERS = {
+    "Accept": "application/vnd.github+json",
+    "X-GitHub-Api-Version": "2022-11-28",
+}
+
+# Matches SSH (scp-like and `ssh://`) and HTTPS Git remote URLs, capturing the repository owner
+# and name.
+_REMOTE_URL_RE = re.compile(
+    r"(?:[^@/\s]+@[^:/\s]+:|(?:ssh|https?)://[^/\s]+/)([^/\s]+)/([^/\s]+?)(?:\.git)?/?"
+)
+
+# Matches pre-release versions, capturing the release, the first letter of the pre-release label
+# and the (optional) pre-release number.
+_PRERELEASE_RE = re.compile(r"^([^-]+)-([a-z])[a-z]*\.?(\d*)", re.IGNORECASE)
+
+
+def _request(method: str, url: str, **kwargs: Any) -> urllib3.HTTPResponse:
+    """
+    Sends a request, through the proxy from the environment unless the host is excluded from it
+    (`NO_PROXY`).
+
+    :arg method: HTTP method.
+    :arg url: Request URL.
+    :arg kwargs: Other arguments for `urllib3.PoolManager.request`.
+
+    :return: The response.
+    """
+
+    pool = _http
+    if _http_proxy is not None and not proxy_bypass(urllib3.util.parse_url(url).host or ""):
+        pool = _http_proxy
+
+    return pool.request(method, url, **kwargs)
+
+
+def _decode_json(data: bytes) -> Any:
+    """
+    Decodes a JSON response body.
+
+    :arg data: Raw response body.
+
+    :return: The decoded JSON value, or `None` if the body isn't valid JSON.
+    """
+
+    try:
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+def _format_error(status: int, data: bytes, data_json: Any) -> str:
+    """
+    Formats an error message for a failed GitHub API call.
+
+    :arg status: Response status code.
+    :arg data: Raw response body.
+    :arg data_json: The decoded response body, or `None` if it isn't valid JSON.
+
+    :return: The error message, with the response body pretty-printed if it's JSON, otherwise as
+        is (e.g. an HTML error page from a proxy).
+    """
+
+    if data_json is None:
+        details = data.decode("utf-8", "replace")
+    else:
+        details = json.dumps(data_json, indent=4)
+
+    # The message is displayed through `cleo`, which would read tags in the body as styles.
+    return f"Request failed with status code {status}:\n{Formatter.escape(details)}"
+
+
+def _parse_remote_url(url: str) -> Optional[Tuple[str, str]]:
+    """
+    Extracts the repository owner and name from a Git remote URL.
+
+    :arg url: An SSH (`git@host:owner/name.git` or `ssh://git@host/owner/name.git`) or HTTPS
+        (`https://host/owner/name.git`) URL.
+
+    :return: A tuple of repository owner and name, or `None` if the URL is not recognized.
+    """
+
+    result = _REMOTE_URL_RE.fullmatch(url)
+    if result is None:
+        return None
+
+    return result.group(1), result.group(2)
 
 
 @dataclass
@@ -44,83 +169,90 @@ class ReleaseCommand(Command):
 
     name: str = "release"
     description: str = "Create a git tag and a GitHub release."
-    options = [option("--pre-release", "-p", description="Mark the release as a pre-release.")]
+    options = [
+        option("--pre-release", "-p", description="Mark the release as a pre-release."),
+        option(
+            "--parallel-uploads",
+            description="Maximum number of assets to upload at the same time.",
+            flag=False,
+            default="4",
+        ),
+    ]
+
+    __package_names: Optional[Tuple[str, str]] = None
+
+    @property
+    def _package_names(self) -> Tuple[str, str]:
+        """
+        Name of the current project's package, as used in build file names. Cached since it doesn't
+        change during a single command invocation.
 
-    _poetry: Poetry = Factory().create_poetry()
+        :return: A tuple of the pretty name (used for source distributions) and the escaped name
+            (used for wheels).
+        """
+
+        if self.__package_names is None:
+            pretty_name = self.poetry.package.pretty_name
+            self.__package_names = (pretty_name, escape_name(pretty_name))
+
+        return self.__package_names
 
-    def __find_git_remotes(self, lines: List[str]) -> List[GitRemote]:
+    def __find_git_remotes(self, path: Path) -> Iterator[GitRemote]:
         """
         Finds remotes in the Git configuration.
 
-        :arg lines: Lines in the configuration file.
+        :arg path: Path to the configuration file.
 
-        :return: A list of Git remotes.
-        """
+        :return: An iterator over Git remotes. The whole configuration file is parsed when the first
+            remote is requested, only the remote URLs are parsed as the remotes are consumed.
 
-        remote_pattern = re.compile(r'\[remote "([a-z]*)"\]\n')
-        remotes: List[GitRemote] = []
-        i = 0
-        while i < len(lines):
-            # Preprare data.
-            line: str = lines[i]
+        :raises configparser.Error: If the configuration file can't be parsed, always on the first
+            `next()` call.
+        """
 
-            # Increment line index.
-            i += 1
+        # Git configuration is in INI format. It can contain repeated keys (e.g. multiple `fetch`
+        # refspecs under the same remote), so strict mode has to be disabled, and keys without a
+        # value (e.g. a bare `bare`, meaning true).
+        config = configparser.RawConfigParser(strict=False, allow_no_value=True)
+        config.read(path, encoding="UTF-8")
 
+        for section in config.sections():
             # Look for the remote header.
-            result = remote_pattern.match(line)
-            if result is None:
+            if not section.startswith('remote "'):
                 continue
-            remote_name = result.group(1)
+            remote_name = section[8:-1]
 
-            # Collect URL under current header.
-            remote_url: str = ""
-            while not lines[i].startswith("["):
-                if lines[i].strip().startswith("url = "):
-                    remote_url = lines[i].split("=")[-1].strip()
-                i += 1
-
-            # If the remote URL was not found, skip.
+            # If the remote URL was not found, skip. A more indented line after the URL is read as
+            # a continuation of its value, while Git reads it as a separate key, so only the first
+            # line is the URL.
+            remote_url: str = (config.get(section, "url", fallback=None) or "").partition("\n")[0]
             if len(remote_url) == 0:
                 continue
 
-            # Get repositry name and owner from the remote URL.
-            if remote_url.startswith("git@"):
-                # SSH URL
-                remote_repo_owner = remote_url.split(":")[-1].split("/")[0]
-                remote_repo_name = remote_url.split(":")[-1].split("/")[1]
-            else:
-                # HTTPS URL
-                remote_repo_owner = remote_url.split("/")[-2]
-                remote_repo_name = remote_url.split("/")[-1]
-
-            # Remove .git from the repositry name if it exists.
-            if remote_repo_name.endswith(".git"):
-                remote_repo_name = remote_repo_name[:-4]
-
-            # Add remote to list.
-            remotes.append(
-                GitRemote(
-                    name=remote_name,
-                    url=remote_url,
-                    repo_name=remote_repo_name,
-                    repo_owner=remote_repo_owner,
-                )
-            )
+            # Get repositry owner and name from the remote URL. Remotes with an unrecognized URL are
+            # still yielded, without the repository fields, so they count towards the remotes found.
+            repo = _parse_remote_url(remote_url)
+            if repo is None:
+                yield GitRemote(name=remote_name, url=remote_url)
+                continue
 
-        return remotes
+            yield GitRemote(
+                name=remote_name,
+                url=remote_url,
+                repo_name=repo[1],
+                repo_owner=repo[0],
+            )
 
     def __github_create_release(
-        self, remote: GitRemote, version: str, username: str, token: str, pre_release: bool
+        self, remote: GitRemote, version: str, pre_release: bool, headers: Dict[str, str]
     ) -> Union[GitHubRelease, str]:
         """
         Creates a release on GitHub.
 
         :arg remote: A Git remote instance. The repository name and owner are read from here.
         :arg version: Version of the software being released.
-        :arg username: GitHub username.
-        :arg token: GitHub token.
         :arg pre_release: If this release should be a pre-release.
+        :arg headers: Headers for GitHub API calls, including authorization.
 
         :return: The created GitHub release object, or an error message if release creation was not
             successful.
@@ -132,91 +264,126 @@ class ReleaseCommand(Command):
         )
 
         # Post to create a new release. If the tag doesn't exist, it will be automatically created.
-        response = requests.post(
-            url=github_api_releases,
-            auth=(username, token),
-            json={
-                "tag_name": version,
-                "target_commitish": "main",
-                "generate_release_notes": True,
-                "prerelease": pre_release,
-            },
+        response = _request(
+            "POST",
+            github_api_releases,
+            headers={**headers, "Content-Type": "application/json"},
+            body=json.dumps(
+                {
+                    "tag_name": version,
+                    "target_commitish": "main",
+                    "generate_release_notes": True,
+                    "prerelease": pre_release,
+                }
+            ).encode(),
             timeout=60,
         )
 
+        # Decode the response body once, it's needed for both the error and the success case.
+        response_json = _decode_json(response.data)
+
         # If request wasn't successful, return an error.
-        if response.status_code != 201:
-            return f"Request failed with status code {response.status_code}:\n" + json.dumps(
-                response.json(), indent=4
-            )
+        if response.status != 201:
+            return _format_error(response.status, response.data, response_json)
 
         # Prepare the `GitHubRelease` object.
-        response_json = response.json()
         release = GitHubRelease(
             uid=int(response_json["id"]),
             url=response_json["url"],
-            url_upload=response_json["upload_url"].split("{")[0],
+            url_upload=response_json["upload_url"].partition("{")[0],
         )
 
         return release
 
     def __github_upload_asset(
-        self, asset: Path, release: GitHubRelease, username: str, token: str
+        self, asset: Path, size: int, release: GitHubRelease, headers: Dict[str, str]
     ) -> Optional[str]:
         """
         Upload assets to an existing GitHub release.
 
         :arg asset: Path to the asset.
+        :arg size: Size of the asset in bytes.
         :arg release: GitHub release instance.
-        :arg username: GitHub username.
-        :arg token: GitHub token.
+        :arg headers: Headers for GitHub API calls, including authorization.
 
         :return: `None` on success, otherwise an error message.
         """
 
-        # Make sure that the provided asset does exist.
-        if not os.path.exists(asset) or not os.path.isfile(asset):
-            return "Provided asset file doesn't exist or isn't a file."
-
-        # Upload asset.
-        with open(asset, "rb") as file:
-            data: bytes = file.read()
-
         # Deterine the data type of the asset.
-        content_type_bytes = "application/octet-stream"
         content_type = {
             ".gz": "application/gzip",
-        }.get(os.path.splitext(asset)[-1], content_type_bytes)
-
-        # Prepare asset data for upload. This makes the octet-stream data upload as
-        # 'multipart/form-data'. GitHub API requires this, not sure why. And if other
-        # data type, such as gzip, are uploaded the same way, they get corrupted; so
-        # they are uploaded without multipart.
-        kwargs = {}
-        if content_type == content_type_bytes:
-            kwargs["files"] = {"file": ("file", data, content_type)}
-        else:
-            kwargs["data"] = data
-            kwargs["headers"] = {"Content-Type": content_type}
-
-        # Post the file.
-        response = requests.post(
-            url=release.url_upload,
-            auth=(username, token),
-            params=[("name", os.path.basename(asset))],
-            **kwargs,
-            timeout=120,
-        )
+        }.get(os.path.splitext(asset)[-1], "application/octet-stream")
 
-        # If request wasn't successful, return an error.
-        if response.status_code != 201:
-            return (
-                f"Request failed with status code {response.status_code}:\n"
-                + json.dumps(response.json(), indent=4)
-                + "\n"
-                + str(response.request.headers)
+        # Stream the file as the raw request body, instead of reading it into memory first. The
+        # length is sent explicitly so the body isn't sent with chunked transfer encoding, which
+        # GitHub's upload endpoint doesn't handle reliably.
+        with open(asset, "rb") as file:
+            response = _request(
+                "POST",
+                f"{release.url_upload}?{urlencode({'name': os.path.basename(asset)})}",
+                headers={
+                    **headers,
+                    "Content-Type": content_type,
+                    "Content-Length": str(size),
+                },
+                body=file,
+                timeout=120,
             )
 
+        # If request wasn't successful, return an error.
+        if response.status != 201:
+            return _format_error(response.status, response.data, _decode_json(response.data))
+
+    def __upload_assets(
+        self,
+        assets: List[Tuple[Path, int]],
+        release: GitHubRelease,
+        headers: Dict[str, str],
+        parallel_uploads: int,
+    ) -> List[str]:
+        """
+        Upload assets to an existing GitHub release concurrently.
+
+        :arg assets: Paths to the assets, each with the size of the asset in bytes.
+        :arg release: GitHub release instance.
+        :arg headers: Headers for GitHub API calls, including authorization.
+        :arg parallel_uploads: Maximum number of assets to upload at the same time.
+
+        :return: A message for each asset describing the upload result, in the same order as
+            `assets`.
+        """
+
+        messages: List[str] = [""] * len(assets)
+        with ThreadPoolExecutor(max_workers=min(parallel_uploads, len(assets))) as pool:
+            futures = {
+                pool.submit(
+                    self.__github_upload_asset,
+                    asset=asset,
+                    size=size,
+                    release=release,
+                    headers=headers,
+                ): i
+                for i, (asset, size) in enumerate(assets)
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                message = f"  {i + 1}. Uploading '{os.path.basename(assets[i][0])}'..."
+
+                # Errors raised by one upload shouldn't hide the results of the others.
+                try:
+                    result = future.result()
+                except (urllib3.exceptions.HTTPError, OSError) as ex:
+                    result = str(ex)
+
+                # Upload failed.
+                if result is not None:
+                    messages[i] = f"{message} Failed.\n{result}"
+                    continue
+
+                messages[i] = f"{message} Done."
+
+        return messages
+
     def __get_built_files(self, version: str) -> List[Path]:
         """
         Find files created by the `poetry build` command.
@@ -226,11 +393,47 @@ class ReleaseCommand(Command):
         :return: A list of paths to build output files.
         """
 
-        dist = self._poetry.file.parent / "dist"
-        wheels = list(dist.glob(f"{escape_name(self._poetry.package.pretty_name)}-{version}-*.whl"))
-        tars = list(dist.glob(f"{self._poetry.package.pretty_name}-{version}.tar.gz"))
+        dist = self.poetry.pyproject_path.parent / "dist"
+        pretty_name, escaped_name = self._package_names
+        wheel_prefix = f"{escaped_name}-{version}-"
+        tar_name = f"{pretty_name}-{version}.tar.gz"
+
+        # Collect wheels and source distributions in a single pass over the directory.
+        files: List[Path] = []
+        try:
+            with os.scandir(dist) as entries:
+                for entry in entries:
+                    if entry.name == tar_name or (
+                        entry.name.startswith(wheel_prefix) and entry.name.endswith(".whl")
+                    ):
+                        files.append(Path(entry.path))
+        except FileNotFoundError:
+            return files
+
+        files.sort()
+        return files
+
+    def __check_built_files(self, files: List[Path]) -> Union[List[int], str]:
+        """
+        Make sure that every build output file does exist and is a regular file.
+
+        :arg files: Paths to build output files.
+
+        :return: Sizes of the files in bytes, in the same order as `files`, or an error message if
+            one of the files doesn't exist or isn't a file.
+        """
+
+        sizes: List[int] = []
+        for file in files:
+            try:
+                file_stat: Optional[os.stat_result] = os.stat(file)
+            except OSError:
+                file_stat = None
+            if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+                return f"Build artifact '{file.name}' doesn't exist or isn't a file."
+            sizes.append(file_stat.st_size)
 
-        return sorted(wheels + tars)
+        return sizes
 
     def handle(self) -> int:
         """
@@ -240,49 +443,65 @@ class ReleaseCommand(Command):
         """
 
         # Check if "version" field exists in the Poetry configuration.
-        if "version" not in self._poetry.local_config:
+        if "version" not in self.poetry.local_config:
             self.line("Missing 'version' field in configuration.")
             return 1
 
-        # Get the version string.
-        version: str = self._poetry.local_config["version"]
-        short_version: str = version
-        if "-" in version:
-            split_version = version.split("-")
-            short_version = (
-                split_version[0]
-                + split_version[1][0]
-                + "".join(char for char in split_version[1] if char.isnumeric())
+        # Get the maximum number of concurrent asset uploads.
+        try:
+            parallel_uploads = int(self.option("parallel-uploads"))
+        except ValueError:
+            parallel_uploads = 0
+        if not 1 <= parallel_uploads <= _HTTP_POOL_MAXSIZE:
+            self.line(
+                "The '--parallel-uploads' option must be an integer from 1 to"
+                f" {_HTTP_POOL_MAXSIZE}."
             )
-        # Get the root directory of project.
-        project_root_path: str = os.path.split(self._poetry.file.path)[0]
+            return 6
+
+        # Get the version string.
+        version: str = self.poetry.local_config["version"]
+        # Shorten pre-release versions to match build file names (`1.0.0-alpha.1` to `1.0.0a1`).
+        prerelease = _PRERELEASE_RE.match(version)
+        short_version: str = (
+            f"{prerelease[1]}{prerelease[2]}{prerelease[3]}" if prerelease else version
+        )
+
         # Get the git configuration file in the project root.
-        git_config_path: str = os.path.join(project_root_path, ".git/config")
+        git_config_path: Path = self.poetry.pyproject_path.parent / ".git" / "config"
 
         # Check if the git configuration file exists.
-        if not os.path.exists(git_config_path):
+        if not git_config_path.is_file():
             self.line("Working directory is not a git repository.")
             return 2
 
-        # Get git remotes from the configuration
-        with open(git_config_path, "r", encoding="UTF-8") as file:
-            git_config_data = file.readlines()
-        remotes: List[GitRemote] = self.__find_git_remotes(git_config_data)
+        # Get git remotes from the configuration. Only the first two are needed to tell if there
+        # is exactly one. The whole file is parsed on the first `next()` call, so that's the only
+        # call that can raise a parsing error.
+        remotes: Iterator[GitRemote] = self.__find_git_remotes(git_config_path)
+        try:
+            remote: Optional[GitRemote] = next(remotes, None)
+        except configparser.Error as ex:
+            self.line(f"Failed to parse the git configuration:\n{ex}")
+            return 8
 
         # Not git remotes in the configuration, no where to upload the release.
-        if len(remotes) == 0:
+        if remote is None:
             self.line("Found 0 git remotes.")
             return 3
 
         # Multiple git remotes currently not supported.
-        if len(remotes) > 1:
+        # TODO: Should be replaced with a decision to pick one of multiple if there is multiple
+        # and have this error removed.
+        if next(remotes, None) is not None:
             self.line("Found multiple git remotes, which is currently not supported.")
             return 99
 
-        # Get a single remote.
-        # TODO: Should be replaced with a decision to pick one of multiple if there is multiple
-        # and have the above error removed.
-        remote: GitRemote = remotes[0]
+        # The remote URL has to point to a GitHub repository.
+        if len(remote.repo_owner) == 0:
+            self.line(f"Unable to find a GitHub repository in the '{remote.name}' remote URL:")
+            self.line(f"  {remote.url}")
+            return 9
 
         # Get a token from the environment.
         if "GITHUB_TOKEN" not in os.environ:
@@ -294,19 +513,27 @@ class ReleaseCommand(Command):
 
         github_token = os.environ["GITHUB_TOKEN"]
 
-        # Get the username from the git configuration.
-        result = subprocess.run(
-            ["git", "config", "user.username"], capture_output=True, check=False
-        )
-        github_username = result.stdout.decode().strip()
+        # Authenticate all requests made to the GitHub API.
+        headers: Dict[str, str] = {**_HEADERS, "Authorization": f"Bearer {github_token}"}
+
+        # Files to be uploaded as assets. Checked before the release is created, so that a release
+        # without assets isn't left behind on GitHub.
+        files: List[Path] = self.__get_built_files(short_version)
+        if len(files) == 0:
+            self.line(f"No build artifacts found for version {version}, run 'poetry build' first.")
+            return 7
+
+        sizes = self.__check_built_files(files)
+        if isinstance(sizes, str):
+            self.line(sizes)
+            return 7
 
         # Create a git tag and a GitHub release.
         github_release = self.__github_create_release(
             remote=remote,
             version="v" + version,
-            username=github_username,
-            token=github_token,
             pre_release=self.option("pre-release", False),
+            headers=headers,
         )
         if isinstance(github_release, str):
             self.line(github_release)
@@ -318,27 +545,16 @@ class ReleaseCommand(Command):
             f"  https://github.com/{remote.repo_owner}/{remote.repo_name}/releases/tag/v{version}"
         )
 
-        # Files to be uploaded as assets.
-        files: List[Path] = self.__get_built_files(short_version)
-
-        if len(files) > 0:
-            self.line(f"Attempting to attach {len(files)} asset(s) to the release.")
-
-        for i, file in enumerate(files):
-            self.write(f"  {i + 1}. Uploading '{os.path.basename(file)}'...")
-
-            # Try to upload asset.
-            result = self.__github_upload_asset(
-                asset=file, release=github_release, username=github_username, token=github_token
-            )
-
-            # Upload failed.
-            if result is not None:
-                self.line(" Failed.")
-                self.line(result)
-                continue
+        self.line(f"Attempting to attach {len(files)} asset(s) to the release.")
 
-            self.line(" Done.")
+        # Upload assets and display the results.
+        for message in self.__upload_assets(
+            assets=list(zip(files, sizes)),
+            release=github_release,
+            headers=headers,
+            parallel_uploads=parallel_uploads,
+        ):
+            self.line(message)
 
         return 0
 